@@ -3,23 +3,21 @@
 # =========================
 
 import os
-import json
+import re
+import orjson
+import hashlib
+import sqlite3
+import time
+import numpy as np
 import pandas as pd
 import streamlit as st
-from datetime import datetime
+from datetime import datetime, timedelta, timezone
 import smtplib
+from contextlib import closing
 from email.message import EmailMessage
 
-# -------------------------
-# GOOGLE SHEETS
-# -------------------------
-import gspread
-from google.oauth2.service_account import Credentials
-
-# -------------------------
-# GEMINI
-# -------------------------
-import google.generativeai as genai
+# gspread, google-auth and google-generativeai are imported where they are
+# first used, so the first widgets paint before those modules load
 
 # =========================
 # STREAMLIT SETUP & HEADER
@@ -65,8 +63,23 @@ st.markdown("---")
 # CONFIG
 # =========================
 SHEET_NAME = "Job Tracker"
+# Compiled once, used per job row; the domain must end in a letter-only TLD
+EMAIL_RE = re.compile(r"[^@\s<>,;]+@[^@\s<>,;]+\.[A-Za-z]{2,}")
+
+def normalize_email(value):
+    # LLM output often pads addresses, wraps them in <...>, prefixes "mailto:"
+    # or leaves trailing punctuation from the surrounding sentence. Lowercased
+    # so the sent-set lookup is case-insensitive.
+    if not isinstance(value, str):
+        return value
+    value = value.strip().lstrip("<(\"'").rstrip(">)\"'.,;:!?")
+    if value.lower().startswith("mailto:"):
+        value = value[len("mailto:"):].strip()
+    return value.lower()
 
 def get_or_create_user_sheet(client, spreadsheet_name, user_email):
+    import gspread
+
     sh = client.open(spreadsheet_name)
 
     # Safe worksheet name
@@ -94,6 +107,117 @@ def get_or_create_user_sheet(client, spreadsheet_name, user_email):
     return worksheet
 
 
+@st.cache_data(ttl=60, show_spinner=False)
+def load_sheet_data(_sheet, sheet_title):
+    # Single values.get round-trip; cached so reruns don't hit the API.
+    # Sent addresses are derived here so they refresh together with the frame.
+    rng = _sheet.get_values("A1:H", value_render_option="UNFORMATTED_VALUE")
+    data = pd.DataFrame(rng[1:], columns=rng[0]) if rng else pd.DataFrame()
+    if "Status" in data.columns:
+        sent = frozenset(
+            normalize_email(e) for e in data.loc[data["Status"] == "SENT", "Contact Email"]
+        )
+    else:
+        sent = frozenset()
+    return data, sent
+
+
+def queue_sent_row(sheet, row):
+    # Every sent row goes through this queue, which holds it only until the
+    # sheet write succeeds – the sheet is what blocks duplicates across sessions
+    st.session_state["pending_rows"].append(row)
+    st.session_state["pending_sheet"] = sheet
+
+
+def flush_pending_rows():
+    # Write the queued rows (normally just the latest send, plus any whose
+    # earlier write failed) with a single values.append call.
+    # On failure the rows stay queued and True/False reports the outcome.
+    rows = st.session_state["pending_rows"]
+    if not rows:
+        return True
+    try:
+        st.session_state["pending_sheet"].append_rows(rows, value_input_option="RAW")
+    except Exception as e:
+        st.error(
+            f"Email(s) sent, but {len(rows)} row(s) could not be logged to the sheet: {e}. "
+            "They stay queued and will be retried."
+        )
+        return False
+    st.session_state["pending_rows"] = []
+    st.session_state["pending_sheet"] = None
+    load_sheet_data.clear()
+    return True
+
+
+def build_sent_set(sheet_sent):
+    # Addresses already mailed, from the sheet plus rows not yet flushed
+    return sheet_sent | {row[3] for row in st.session_state["pending_rows"]}
+
+
+def close_smtp(server):
+    if server is None:
+        return
+    try:
+        server.quit()
+    except (smtplib.SMTPException, OSError):
+        server.close()
+
+
+def get_smtp(user_email, app_password):
+    # One SMTP session per user session – skips TLS handshake + login per email
+    server = st.session_state.pop("smtp_server", None)
+    if server is not None and st.session_state.get("smtp_user") == user_email:
+        try:
+            server.noop()
+            st.session_state["smtp_server"] = server
+            return server
+        except (smtplib.SMTPException, OSError):
+            pass  # Connection dropped, reconnect below
+    # Other sender or dead connection – close it before opening a new one
+    close_smtp(server)
+
+    server = smtplib.SMTP("smtp.gmail.com", 587)
+    try:
+        server.starttls()
+        server.login(user_email, app_password)
+    except Exception:
+        server.close()
+        raise
+    st.session_state["smtp_server"] = server
+    st.session_state["smtp_user"] = user_email
+    return server
+
+
+# LinkedIn UI chrome that shows up as standalone lines in scraped text
+LINKEDIN_NOISE = frozenset({
+    "See more", "…see more", "...see more", "See less", "Show translation",
+    "Promoted", "Follow", "+ Follow", "Following", "Feed post", "Edited",
+    "Like", "Comment", "Repost", "Send", "Share", "Reply",
+    "Celebrate", "Support", "Love", "Insightful", "Funny",
+    "Load more comments", "Visible to anyone on or off LinkedIn",
+})
+
+def clean_linkedin(text):
+    # Drop UI noise, punctuation-only fragments and back-to-back repeats to cut
+    # prompt tokens. Runs of blank lines collapse to one, keeping the breaks
+    # between posts; only consecutive duplicates are removed, since lines such
+    # as a location or job type legitimately repeat across different postings.
+    out = []
+    for ln in text.splitlines():
+        s = ln.strip()
+        if not s:
+            if out and out[-1]:
+                out.append("")
+            continue
+        if s in LINKEDIN_NOISE or (len(s) < 3 and not any(c.isalnum() for c in s)):
+            continue
+        if out and s == out[-1]:
+            continue
+        out.append(s)
+    return "\n".join(out).rstrip("\n")
+
+
 # =========================
 # UPLOAD RESUME
 # =========================
@@ -105,6 +229,12 @@ if uploaded_resume is None:
     st.info("Please upload your resume to continue.")
     st.stop()
 
+# Copied only when a different file is uploaded, not on every rerun
+if st.session_state.get("resume_file_id") != uploaded_resume.file_id:
+    st.session_state["resume_bytes"] = uploaded_resume.getvalue()
+    st.session_state["resume_name"] = uploaded_resume.name
+    st.session_state["resume_file_id"] = uploaded_resume.file_id
+
 # =========================
 # DYNAMIC SENDER EMAIL INPUT
 # =========================
@@ -144,18 +274,51 @@ scope = [
     "https://spreadsheets.google.com/feeds",
     "https://www.googleapis.com/auth/drive",
 ]
-creds_sheet = Credentials.from_service_account_info(st.secrets["GOOGLE_CREDENTIALS"],
-    scopes=scope
-)
-client = gspread.authorize(creds_sheet)
-sheet = get_or_create_user_sheet(client, SHEET_NAME, sender_email)
 
-data = pd.DataFrame(sheet.get_all_records())
+@st.cache_resource(show_spinner=False)
+def get_sheet_client():
+    # google-auth credentials; gspread wraps them in a pooled AuthorizedSession
+    # that is kept alive with this cached client
+    import gspread
+    from google.oauth2.service_account import Credentials
+
+    creds_sheet = Credentials.from_service_account_info(st.secrets["GOOGLE_CREDENTIALS"],
+        scopes=scope
+    )
+    return gspread.authorize(creds_sheet)
+
+@st.cache_resource(show_spinner=False)
+def get_worksheet(user_email):
+    # Reused across reruns instead of re-opening the spreadsheet every interaction
+    return get_or_create_user_sheet(get_sheet_client(), SHEET_NAME, user_email)
+
+sheet = get_worksheet(sender_email)
+
+if "pending_rows" not in st.session_state:
+    st.session_state["pending_rows"] = []
+    st.session_state["pending_sheet"] = None
+
+# Rows left over for another sender's worksheet are written before switching
+pending_sheet = st.session_state["pending_sheet"]
+if pending_sheet is not None and pending_sheet.title != sheet.title:
+    if not flush_pending_rows():
+        st.stop()
+
+data, sheet_sent = load_sheet_data(sheet, sheet.title)
 
 st.subheader("📊 Job Tracker (Google Sheet)")
 if st.button("🔄 Refresh Sheet"):
-    data = pd.DataFrame(sheet.get_all_records())
+    load_sheet_data.clear()
+    data, sheet_sent = load_sheet_data(sheet, sheet.title)
     st.success("✅ Sheet refreshed")
+if st.session_state["pending_rows"]:
+    st.caption(f"{len(st.session_state['pending_rows'])} sent application(s) not yet written to the sheet")
+    if st.button("📤 Retry Sheet Write") and flush_pending_rows():
+        data, sheet_sent = load_sheet_data(sheet, sheet.title)
+        st.success("✅ Sheet updated")
+# Rebuilt from the cached frame each run, so it tracks what the table shows
+sent_set = build_sent_set(sheet_sent)
+
 if data.empty:
     st.info("Sheet is currently empty.")
 else:
@@ -173,17 +336,26 @@ if uploaded_file is None:
     st.info("Please upload a TXT file to continue.")
     st.stop()
 
-gemini_input_text = uploaded_file.read().decode("utf-8", errors="ignore")
+raw_text = uploaded_file.read().decode("utf-8", errors="ignore")
+gemini_input_text = clean_linkedin(raw_text)
 post_id = uploaded_file.name.replace(".txt", "")
 
 st.success(f"File loaded: {uploaded_file.name}")
-st.caption(f"Text length: {len(gemini_input_text)} characters")
+st.caption(f"Text length: {len(gemini_input_text)} characters ({len(raw_text)} before cleanup)")
 
 # =========================
 # GEMINI SETUP
 # =========================
-genai.configure(api_key=st.secrets["GEMINI_API_KEY"])  # Replace with your Gemini API key
-model = genai.GenerativeModel("gemini-2.5-flash")
+@st.cache_resource(show_spinner=False)
+def get_gemini():
+    # Configured once per process from st.secrets, not on every rerun
+    import google.generativeai as genai
+
+    genai.configure(api_key=st.secrets["GEMINI_API_KEY"])
+    return genai
+
+genai = get_gemini()
+GEMINI_MODEL = "gemini-2.5-flash"
 
 PROMPT =f"""
 You are a highly skilled AI assistant specialized in analyzing job postings and drafting professional job application emails.
@@ -237,46 +409,182 @@ Additional instructions:
 - Ensure all extracted jobs are unique
 - Validate that `apply_email` looks legitimate (contains "@" and domain)
 - Include only jobs in India
-
-TEXT TO ANALYZE:
 """
 
-# =========================
-# RUN GEMINI ANALYSIS
-# =========================
-st.subheader("🤖 Analyze Jobs")
+# Bump whenever PROMPT changes so cached analyses are invalidated
+PROMPT_VERSION = "2"
+# Hashed once per run; PROMPT is never concatenated with the uploaded text
+PROMPT_HASH = hashlib.sha256(f"{PROMPT_VERSION}\n{PROMPT}".encode()).hexdigest()
+
+@st.cache_resource(show_spinner=False)
+def get_prompt_caches():
+    # Process-wide: cache key -> CachedContent, or None when the prompt is too
+    # small to cache, so sessions with the same prompt share one cache
+    return {}
+
+def get_prompt_model():
+    # Register the static prompt once as Gemini cached content, so each call
+    # only sends the TXT body as new input tokens
+    from google.api_core import exceptions as google_exceptions
+
+    cache_key = f"rolematch-{PROMPT_VERSION}-{PROMPT_HASH[:16]}"
+    # Caches for superseded prompts are left to their 1h TTL: another session
+    # with the same prompt may still be using them
+    caches = get_prompt_caches()
+
+    if cache_key in caches:
+        cache = caches[cache_key]
+        if cache is None:
+            return genai.GenerativeModel(GEMINI_MODEL, system_instruction=PROMPT)
+        if cache.expire_time > datetime.now(timezone.utc) + timedelta(minutes=1):
+            return genai.GenerativeModel.from_cached_content(cached_content=cache)
 
-if st.button("Analyze TXT with Gemini"):
-    with st.spinner("Analyzing jobs..."):
+    try:
+        cache = genai.caching.CachedContent.create(
+            model=GEMINI_MODEL,
+            display_name=cache_key,
+            system_instruction=PROMPT,
+            ttl=timedelta(hours=1),
+        )
+    except (
+        google_exceptions.InvalidArgument,
+        google_exceptions.ResourceExhausted,
+        google_exceptions.PermissionDenied,
+    ):
+        # Prompt below the minimum cacheable size, or caching unavailable on
+        # this key (free tier has a caching quota of 0) – remember it and send
+        # the prompt as a plain system instruction from now on
+        caches[cache_key] = None
+        return genai.GenerativeModel(GEMINI_MODEL, system_instruction=PROMPT)
+
+    caches[cache_key] = cache
+    return genai.GenerativeModel.from_cached_content(cached_content=cache)
+
+JOB_COLUMNS = [
+    "job_title",
+    "company",
+    "apply_email",
+    "job_type",
+    "location",
+    "skills",
+    "jd_summary",
+    "email_subject",
+    "email_body_draft",
+]
+
+# Disk cache of raw Gemini output, shared across sessions and restarts.
+# SQLite handles concurrent access from the per-session script threads.
+ANALYSIS_CACHE_FILE = ".gemini_cache.sqlite3"
+ANALYSIS_CACHE_TTL = 7 * 24 * 3600  # Seconds before a cached analysis expires
+MIN_TEXT_LENGTH = 500  # Shorter uploads can't hold a real job posting
+
+def analysis_cache_key(text):
+    # Feed the hash incrementally instead of building a prompt + text string
+    h = hashlib.sha256(PROMPT_HASH.encode())
+    h.update(text.encode())
+    return h.hexdigest()
+
+def open_analysis_cache():
+    db = sqlite3.connect(ANALYSIS_CACHE_FILE, timeout=10)
+    db.execute(
+        "CREATE TABLE IF NOT EXISTS analyses "
+        "(key TEXT PRIMARY KEY, created REAL NOT NULL, result BLOB NOT NULL)"
+    )
+    return db
+
+# The cache is only an optimization: on any SQLite error (lock timeout,
+# read-only or full disk, corrupt file) carry on without it
+
+def read_cached_analysis(key):
+    try:
+        with closing(open_analysis_cache()) as db:
+            row = db.execute(
+                "SELECT result FROM analyses WHERE key = ? AND created >= ?",
+                (key, time.time() - ANALYSIS_CACHE_TTL),
+            ).fetchone()
+    except sqlite3.Error:
+        return None
+    return orjson.loads(row[0]) if row else None
+
+def store_analysis(key, raw):
+    now = time.time()
+    try:
+        with closing(open_analysis_cache()) as db, db:
+            db.execute("DELETE FROM analyses WHERE created < ?", (now - ANALYSIS_CACHE_TTL,))
+            db.execute(
+                "INSERT OR REPLACE INTO analyses (key, created, result) VALUES (?, ?, ?)",
+                (key, now, raw),
+            )
+    except sqlite3.Error:
+        pass
+
+def analyze_text(text, progress):
+    # Identical uploads for the same prompt are served from disk without calling the API
+    key = analysis_cache_key(text)
+    last = st.session_state.get("last_llm")
+    if last and last[0] == key:
+        return last[1]
+
+    result = read_cached_analysis(key)
+    if result is not None:
+        st.session_state["last_llm"] = (key, result)
+        return result
+
+    model = get_prompt_model()
+
+    # Show progress while the JSON streams in, parse once it is complete
+    buf = []
+    received = 0
+    try:
         response = model.generate_content(
-            PROMPT +  "\n\n" + gemini_input_text,
+            text,
+            stream=True,
             generation_config={
                 "temperature": 0,
                 "response_mime_type": "application/json",
             },
         )
+        for chunk in response:
+            if not chunk.parts:
+                continue  # e.g. a final chunk carrying only finish_reason
+            piece = chunk.text
+            buf.append(piece)
+            received += len(piece)
+            progress.caption(f"Received {received} characters from Gemini...")
+
+        raw = "".join(buf).encode()
+        result = orjson.loads(raw)
+    except Exception as e:
+        st.error(f"Gemini analysis failed: {e}")
+        st.stop()
+    finally:
+        progress.empty()
+    st.session_state["last_llm"] = (key, result)
+    store_analysis(key, raw)
+    return result
+
+# =========================
+# RUN GEMINI ANALYSIS
+# =========================
+st.subheader("🤖 Analyze Jobs")
 
-        gemini_output = json.loads(response.text)
+if st.button("Analyze TXT with Gemini"):
+    if len(gemini_input_text.strip()) < MIN_TEXT_LENGTH:
+        st.warning("Text is too short to analyze.")
+        st.stop()
+
+    progress = st.empty()
+    with st.spinner("Analyzing jobs..."):
+        gemini_output = analyze_text(gemini_input_text, progress)
         jobs = gemini_output.get("jobs", [])
 
-        rows = []
-        for idx, job in enumerate(jobs, start=1):
-            rows.append(
-                {
-                    "job_id": idx,
-                    "job_title": job.get("job_title"),
-                    "company": job.get("company"),
-                    "apply_email": job.get("apply_email"),
-                    "job_type": job.get("job_type"),
-                    "location": job.get("location"),
-                    "skills": job.get("skills"),
-                    "jd_summary": job.get("jd_summary"),
-                    "email_subject": job.get("email_subject"),
-                    "email_body_draft": job.get("email_body_draft")
-                }
-            )
+        job_df = pd.DataFrame(jobs, columns=JOB_COLUMNS)
+        # Missing keys come back as NaN; keep them None like dict.get() did
+        job_df = job_df.astype(object).where(job_df.notna(), None)
+        job_df["apply_email"] = [normalize_email(e) for e in job_df["apply_email"]]
+        job_df.insert(0, "job_id", np.arange(1, len(job_df) + 1))
 
-        st.session_state["job_df"] = pd.DataFrame(rows)
+        st.session_state["job_df"] = job_df
 
 # =========================
 # FILTER SENT EMAILS
@@ -284,18 +592,14 @@ if st.button("Analyze TXT with Gemini"):
 if "job_df" in st.session_state:
     job_df = st.session_state["job_df"]
 
-    if "Status" in data.columns:
-        sent_emails = data.loc[
-            data["Status"] == "SENT", "Contact Email"
-        ].tolist()
-    else:
-        sent_emails = []
-    if "apply_email" not in job_df.columns:
-        job_df["apply_email"] = ""
-
-    job_df_filtered = job_df[(job_df["apply_email"].str.contains("@", na=False)) &
-        (~job_df["apply_email"].isin(sent_emails))
-    ].reset_index(drop=True)
+    # Single fused pass: address validation and sent lookup per email, one mask materialized
+    emails = job_df["apply_email"].to_numpy(dtype=object)
+    eligible = np.fromiter(
+        (isinstance(e, str) and EMAIL_RE.fullmatch(e) is not None and e not in sent_set for e in emails),
+        dtype=bool,
+        count=len(emails),
+    )
+    job_df_filtered = job_df[eligible].reset_index(drop=True)
 
     st.subheader("✅ Eligible Jobs")
     st.dataframe(job_df_filtered, use_container_width=True)
@@ -321,7 +625,7 @@ if "job_df" in st.session_state:
     # =========================
     st.subheader("✉️ Email Editor")
 
-    email_to = st.text_input("To", value=job["apply_email"])
+    email_to = normalize_email(st.text_input("To", value=job["apply_email"]))
     subject = st.text_input("Subject", value=job["email_subject"])
     body = st.text_area(
         "Email Body",
@@ -333,7 +637,7 @@ if "job_df" in st.session_state:
     # SEND EMAIL USING SMTP
     # =========================
     if st.button("🚀 Send Email"):
-        if email_to in sent_emails:
+        if email_to in sent_set:
             st.error("This email was already sent earlier.")
             st.stop()
 
@@ -344,33 +648,35 @@ if "job_df" in st.session_state:
         msg.set_content(body)
 
         msg.add_attachment(
-            uploaded_resume.read(),
+            st.session_state["resume_bytes"],
             maintype="application",
             subtype="pdf",
-            filename=uploaded_resume.name,
+            filename=st.session_state["resume_name"],
         )
 
         try:
-            with smtplib.SMTP("smtp.gmail.com", 587) as server:
-                server.starttls()
-                server.login(sender_email, sender_app_password)
-                server.send_message(msg)
-
-            # Append to sheet
-            new_row = [
-                str(job["job_id"]),
-                job["job_title"],
-                job["company"],
-                email_to,
-                "SENT",
-                "YES",
-                f"Mail sent | Subject: {subject}",
-                datetime.now().strftime("%Y-%m-%d %H:%M"),
-            ]
-            sheet.append_row(new_row)
-
-            st.success("✅ Email sent & sheet updated")
-            st.rerun()
-
+            try:
+                get_smtp(sender_email, sender_app_password).send_message(msg)
+            except smtplib.SMTPServerDisconnected:
+                close_smtp(st.session_state.pop("smtp_server", None))
+                get_smtp(sender_email, sender_app_password).send_message(msg)
         except Exception as e:
             st.error(f"Failed to send email: {e}")
+            st.stop()
+
+        # Logged right away; the queue only keeps the row if the write fails
+        new_row = [
+            str(job["job_id"]),
+            job["job_title"],
+            job["company"],
+            email_to,
+            "SENT",
+            "YES",
+            f"Mail sent | Subject: {subject}",
+            datetime.now().strftime("%Y-%m-%d %H:%M"),
+        ]
+        queue_sent_row(sheet, new_row)
+
+        if flush_pending_rows():
+            st.success("✅ Email sent & logged")
+            st.rerun()